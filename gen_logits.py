@@ -18,7 +18,7 @@ from sklearn.metrics import precision_recall_curve
 from sklearn.metrics import average_precision_score
 
 from dataloader import Threshold_Dataset, data_transforms
-from models import create_model_resnet10, create_model_resnet152, DotProduct_Classifier
+from models import create_model_resnet10, create_model_resnet152, DotProduct_Classifier, precisions, export_int8, GraphedInference
 
 def gen_logits( args, feature_extractor, classifier, device, loader ):
 
@@ -34,9 +34,9 @@ def gen_logits( args, feature_extractor, classifier, device, loader ):
     with torch.no_grad():
         for ind, (data, target, _,  train_count ) in enumerate(loader):
 
-            data, target = data.to(device), target.to(device)
+            data, target = data.to(device, dtype=precisions[args.precision]), target.to(device)
             features, _ = feature_extractor(data)
-            logits = classifier(features)  
+            logits = classifier(features.float())  
 
             total_logits = torch.cat((total_logits, logits))
             total_labels = torch.cat((total_labels, target))
@@ -61,6 +61,11 @@ def main():
     parser.add_argument('--model_name', type=str, default=None, help='name of model : manyshot | mediumshot | fewshot | general')
     parser.add_argument('--data_split', type=str, default=None, help='train | val | test_aligned')
     parser.add_argument('--caffe', action='store_true', default=False, help='caffe pretrained model')
+    parser.add_argument('--compile', action='store_true', default=False, help='compile the feature extractor with torch.compile')
+    parser.add_argument('--cuda_graph', action='store_true', default=False, help='replay the feature extractor as a single cuda graph')
+    parser.add_argument('--int8', action='store_true', default=False, help='int8 quantized feature extractor, runs on cpu in fp32')
+    parser.add_argument('--cudnn_benchmark', action='store_true', default=False, help='let cudnn benchmark all conv kernels, gives up bitwise reproducibility')
+    parser.add_argument('--precision', type=str, default='fp32', choices=list(precisions), help='feature extractor precision : fp32 | fp16 | bf16')
     parser.add_argument('--test', action='store_true', default=False, help='run in test mode')
     parser.add_argument('--no-cuda', action='store_true', default=False, help='disables CUDA training')
     parser.add_argument('--seed', type=int, default=5021, metavar='S', help='random seed (default: 5021)')
@@ -73,11 +78,25 @@ def main():
 
     args = parser.parse_args()
 
+    # the int8 model is an fbgemm (cpu) graph taking fp32 inputs
+    if (args.int8 and args.precision != 'fp32'):
+        parser.error('--int8 takes fp32 inputs, drop --precision {}'.format(args.precision))
+    if (args.int8 and args.cuda_graph):
+        parser.error('--int8 runs on cpu, it can\'t be combined with --cuda_graph')
+    if (args.int8 and args.compile):
+        parser.error('torch.compile can\'t run the quantized ops, --int8 can\'t be combined with --compile')
+
+    # reduce-overhead compilation already replays cuda graphs, and capture needs a gpu
+    if (args.cuda_graph and args.compile):
+        parser.error('--compile already uses cuda graphs, pass only one of --compile and --cuda_graph')
+    if (args.cuda_graph and (args.no_cuda or not torch.cuda.is_available())):
+        parser.error('--cuda_graph needs a cuda device')
+
     print("\n==================Options=================")
     pprint(vars(args), indent=4)
     print("==========================================\n")
 
-    use_cuda = not args.no_cuda and torch.cuda.is_available()
+    use_cuda = not args.no_cuda and not args.int8 and torch.cuda.is_available()
     # make everything deterministic, reproducible
     if (args.seed is not None):
         print('Seeding everything with seed {}.'.format(args.seed))
@@ -85,6 +104,12 @@ def main():
     else:
         print('Note : Seed is random.')
 
+    # fixed input size, let cudnn pick the fastest (nhwc) conv kernels, deterministic or not
+    if (args.cudnn_benchmark):
+        print('Using cudnn benchmark, logits are not bitwise reproducible.')
+        torch.backends.cudnn.deterministic = False
+        torch.backends.cudnn.benchmark = True
+
     device = torch.device("cuda" if use_cuda else "cpu")
 
     exp_dir = os.path.join('checkpoint', args.exp)
@@ -140,13 +165,13 @@ def main():
         class_mask = torch.BoolTensor( [ True for i in range(tot_num_classes) ] )
 
     if (args.dataset.lower() == 'imagenet'):
-        feature_extractor = create_model_resnet10().to(device)  # use this for imagenet
+        feature_extractor = create_model_resnet10(precision=args.precision).to(device)  # use this for imagenet
         if(args.model_name != 'general'):    
             classifier = DotProduct_Classifier(num_classes=int(class_mask.sum() + 1), feat_dim=512, use_logits=True).to(device)            # for experts with oe training
         else:
             classifier = DotProduct_Classifier(num_classes=1000, feat_dim=512, use_logits=True).to(device)
     else:
-        feature_extractor = create_model_resnet152(caffe=True).to(device)  # use this for places. pass caffe=true to load pretrained imagenet model
+        feature_extractor = create_model_resnet152(caffe=True, precision=args.precision).to(device)  # use this for places. pass caffe=true to load pretrained imagenet model
         if (args.model_name != 'general'):
             classifier = DotProduct_Classifier(num_classes=int( class_mask.sum() + 1 ), feat_dim=512, use_logits=True).to(device)           # for experts with oe training
         else:
@@ -169,6 +194,22 @@ def main():
             else:
                 weights_class = {k: weights_class['module.' + k][:-1] if 'module.' + k in weights_class else weights_class[k][:-1] for k in classifier.state_dict()}  # due to a bug, there was an extra neuron for the open class even in the generalist, so must slice it away
             classifier.load_state_dict(weights_class)
+
+    # fold batchnorm into the convs, inference only from here on
+    if(args.int8):
+        feature_extractor = export_int8(feature_extractor, val_loader)          # calibrated on the val split
+    else:
+        feature_extractor.eval().fuse_for_inference()
+
+    # inductor fuses the folded conv bias + relu epilogues, incl. the stem conv-relu-maxpool,
+    # and specializes the kernels to the static shapes (the last, smaller batch is compiled once more)
+    if(args.compile):
+        feature_extractor = torch.compile(feature_extractor, mode='reduce-overhead', dynamic=False)
+
+    # capture the whole (folded) forward once, one graph launch per batch instead of one per kernel
+    elif(args.cuda_graph):
+        example_input = torch.zeros(args.batch_size, 3, 224, 224, dtype=precisions[args.precision], device=device)
+        feature_extractor = GraphedInference(feature_extractor, example_input)
             
     # #####################################################################################
     # ######################## generate logit scores           ############################
@@ -196,15 +196,15 @@ def main():
     if (args.dataset.lower() == 'imagenet'):
         feature_extractor = create_model(use_selfatt=False, use_fc=True).to(device)  # use this for imagenet
         if(args.model_name != 'general'):    
-            classifier = DotProduct_Classifier(num_classes=int(class_mask.sum() ), feat_dim=512).to(device)            # for experts with oe training
+            classifier = DotProduct_Classifier(num_classes=int(class_mask.sum() ), feat_dim=512, use_logits=False).to(device)            # for experts with oe training
         else:
-            classifier = DotProduct_Classifier(num_classes=1000, feat_dim=512).to(device)
+            classifier = DotProduct_Classifier(num_classes=1000, feat_dim=512, use_logits=False).to(device)
     else:
         feature_extractor = create_model_resnet152(use_selfatt=False, use_fc=True, caffe=True).to(device)  # use this for places. pass caffe=true to load pretrained imagenet model
         if (args.model_name != 'general'):
-            classifier = DotProduct_Classifier(num_classes=int( class_mask.sum() ), feat_dim=512).to(device)           # for experts with oe training
+            classifier = DotProduct_Classifier(num_classes=int( class_mask.sum() ), feat_dim=512, use_logits=False).to(device)           # for experts with oe training
         else:
-            classifier = DotProduct_Classifier(num_classes=365, feat_dim=512).to(device)
+            classifier = DotProduct_Classifier(num_classes=365, feat_dim=512, use_logits=False).to(device)
 
     # load pretrained model
     if (args.load_model is not None):
@@ -66,21 +66,22 @@ def test(args, model, device, dataloader):
     criterion = nn.NLLLoss().cuda()
     total_preds = torch.empty((0), dtype=torch.long).to(device)
 
-    for batch_idx, (data, target) in enumerate(dataloader):
+    with torch.no_grad():
+        for batch_idx, (data, target) in enumerate(dataloader):
 
-        sys.stdout.flush()
+            sys.stdout.flush()
 
-        data, target = data.to(device), target.to(device)
-        output = model(data)
-        loss = criterion(output, target)
+            data, target = data.to(device), target.to(device)
+            output = model(data)
+            loss = criterion(output, target)
 
-        total_loss += F.nll_loss(output, target, reduction='sum').item()       	           # sum up batch loss
-        pred = output.max(1, keepdim=True)[1]  									           # get the index of the max logit score
-        total_preds = torch.cat((total_preds, pred))
-        correct += pred.eq(target.view_as(pred)).sum().item()
+            total_loss += F.nll_loss(output, target, reduction='sum').item()       	           # sum up batch loss
+            pred = output.max(1, keepdim=True)[1]  									           # get the index of the max logit score
+            total_preds = torch.cat((total_preds, pred))
+            correct += pred.eq(target.view_as(pred)).sum().item()
 
-        if batch_idx % args.log_interval == 0:
-            print('Test set: [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(batch_idx * len(data), len(dataloader.dataset),100. * batch_idx / len(dataloader), loss.item()))
+            if batch_idx % args.log_interval == 0:
+                print('Test set: [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(batch_idx * len(data), len(dataloader.dataset),100. * batch_idx / len(dataloader), loss.item()))
 
     total_loss /= len(dataloader.dataset)
     acc = 100*correct / len(dataloader.dataset)
@@ -196,7 +197,7 @@ def main():
     if(args.test):
         pretrained_model = torch.load(args.load_model)
         weights = pretrained_model['state_dict_best']['model']
-        weights = {k: weights['module.' + k] if 'module.' + k in weights else weights[k] for k in model.state_dict()}
+        weights = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in weights.items()}        # old checkpoints are converted on load
         model.load_state_dict(weights)                                                                            # loading model weights
         print('Loaded pretrained model.')
 
@@ -36,11 +36,11 @@ def train( args, feature_extractor, classifier, device, train_loader, optimizer,
         features, _ = feature_extractor(data)
         output = classifier(features)
 
-        loss = F.nll_loss(output, target)
+        loss = F.cross_entropy(output, target)
         loss.backward()
         optimizer.step()
-        train_loss += F.nll_loss(output, target, reduction='sum').item()  # sum up batch loss
-        pred = output.max(1, keepdim=True)[1]  # get the index of the max log-probability
+        train_loss += F.cross_entropy(output, target, reduction='sum').item()  # sum up batch loss
+        pred = output.max(1, keepdim=True)[1]  # get the index of the max logit
         correct += pred.eq(target.view_as(pred)).sum().item()
 
         if batch_idx % args.log_interval == 0:
@@ -74,8 +74,8 @@ def test( args, feature_extractor, classifier, device, test_loader ):
             data, target = data.to(device), target.to(device)
             features, _ = feature_extractor(data)
             output = classifier(features)
-            test_loss += F.nll_loss(output, target, reduction='sum').item()  # sum up batch loss
-            pred = output.max(1, keepdim=True)[1]  # get the index of the max log-probability
+            test_loss += F.cross_entropy(output, target, reduction='sum').item()  # sum up batch loss
+            pred = output.max(1, keepdim=True)[1]  # get the index of the max logit
             correct += pred.eq(target.view_as(pred)).sum().item()
 
             if (ind % args.log_interval == 0):
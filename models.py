@@ -1,7 +1,35 @@
+import copy
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from typing import List
 from utils import *
 
+def class_mask_to_idx(mask):
+    """Bool class mask, or list / array of class indices, as a LongTensor of indices"""
+    mask = torch.as_tensor(mask)
+    if mask.dtype == torch.bool:
+        mask = torch.nonzero(mask).view(-1)
+    return mask.long().contiguous()
+
+@torch.jit.script
+def calibrate_experts(x, scale, bias, sizes: List[int], dst_idx: List[torch.Tensor], y, inplace: bool):
+
+    # per index temperature scaling and bias, for all experts at once
+    scaled = torch.addcmul(bias, scale, x)
+
+    # log softmax per expert, dropping the reject option, scattered into the class order of y
+    experts = torch.split(scaled, sizes, dim=1)
+    for i in range(len(experts)):
+        logprobs = F.log_softmax(experts[i], dim=1)[:, :-1]
+        y.index_copy_(1, dst_idx[i], logprobs)
+
+    # normalising in log space (loss function is NLL), in place into y when no autograd is needed
+    lse = torch.logsumexp(y, dim=1, keepdim=True)
+    if inplace:
+        return y.sub_(lse)
+    return y - lse
+
 class CalibrateExperts(nn.Module):
     
     def __init__(self, dataset, manyshotClassMask, mediumshotClassMask, fewshotClassMask, *args):
@@ -17,44 +45,45 @@ class CalibrateExperts(nn.Module):
             self.manyshotRange = (0, 133)
             self.mediumshotRange = (133, 296)
             self.fewshotRange = (296, 368)
+        self._sizes = [end - start for start, end in [self.manyshotRange, self.mediumshotRange, self.fewshotRange]]
+
+        # learning temp and bias per index, manyshot, mediumshot and fewshot concatenated
+        num_logits = self.fewshotRange[1]
+        self.scale = nn.Parameter(torch.ones(1, num_logits))
+        self.bias = nn.Parameter(torch.zeros(1, num_logits))      # additive identity
+
+        # class indices each expert's probabilities are scattered to, uploaded with the model once
+        self.register_buffer('manyshotIdx', class_mask_to_idx(manyshotClassMask), persistent=False)
+        self.register_buffer('mediumshotIdx', class_mask_to_idx(mediumshotClassMask), persistent=False)
+        self.register_buffer('fewshotIdx', class_mask_to_idx(fewshotClassMask), persistent=False)
+
+        # output buffer reused across forward passes at inference
+        self.register_buffer('_y_buf', torch.empty(0), persistent=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the parameters were concatenated
+        for old_name, name in [('Temp', 'scale'), ('Bias', 'bias')]:
+            keys = [prefix + expert + old_name for expert in ['manyshot', 'mediumshot', 'fewshot']]
+            if all(k in state_dict for k in keys):
+                state_dict[prefix + name] = torch.cat([state_dict.pop(k) for k in keys], dim=1)
+        super(CalibrateExperts, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _empty_logprobs(self, x):
+        shape = (x.shape[0], x.shape[1] - len(self._sizes))     # removing reject option indices
+        if torch.is_grad_enabled():     # autograd needs a fresh tensor every step
+            return x.new_full(shape, float('-inf'))
+        if self._y_buf.shape[0] < shape[0] or self._y_buf.shape[1:] != shape[1:] or self._y_buf.device != x.device or self._y_buf.dtype != x.dtype:
+            self._y_buf = x.new_empty(shape)
+        return self._y_buf[:shape[0]].fill_(float('-inf'))
 
-        # learning temp per index
-        self.manyshotTemp = nn.Parameter(torch.ones(1, self.manyshotRange[1] - self.manyshotRange[0])  )
-        self.mediumshotTemp = nn.Parameter(torch.ones(1, self.mediumshotRange[1] - self.mediumshotRange[0]) )
-        self.fewshotTemp = nn.Parameter(torch.ones(1, self.fewshotRange[1] - self.fewshotRange[0]) )
-        
-        # learning bias per index
-        self.manyshotBias = nn.Parameter(torch.ones(1, self.manyshotRange[1] - self.manyshotRange[0]))
-        self.mediumshotBias = nn.Parameter(torch.ones(1, self.mediumshotRange[1] - self.mediumshotRange[0]))
-        self.fewshotBias = nn.Parameter(torch.ones(1, self.fewshotRange[1] - self.fewshotRange[0]))
-
-        self.manyshotClassMask, self.mediumshotClassMask, self.fewshotClassMask = manyshotClassMask, mediumshotClassMask, fewshotClassMask
-    
     def forward(self, x, *args):
-        
-        # slicing logits
-        manyshotLogits = x[:,self.manyshotRange[0]:self.manyshotRange[1]]
-        mediumshotLogits = x[:,self.mediumshotRange[0]:self.mediumshotRange[1]]
-        fewshotLogits = x[:,self.fewshotRange[0]:self.fewshotRange[1]]
-        
-        # per index temperature scaling, bias, and softmax    
-        manyshotProbs = F.softmax((self.manyshotTemp * manyshotLogits) + self.manyshotBias, dim=1)[:,:-1]
-        mediumshotProbs = F.softmax((self.mediumshotTemp * mediumshotLogits) + self.mediumshotBias, dim=1)[:,:-1]
-        fewshotProbs = F.softmax((self.fewshotTemp * fewshotLogits) + self.fewshotBias, dim=1)[:,:-1]
-        
-        # concatenating, normalising, and taking log (loss function is NLL)    
-        y = Variable(torch.zeros(x.shape[0], x.shape[1]-3), requires_grad=True).cuda()     # removing reject option indices
-        y[:,self.manyshotClassMask] = manyshotProbs
-        y[:,self.mediumshotClassMask] = mediumshotProbs
-        y[:,self.fewshotClassMask] = fewshotProbs
-        y = y / y.sum(dim=1).unsqueeze(1)
-        y = torch.log(y)
-
-        return y
+        # without grad the output is the reused buffer, overwritten by the next forward
+        return calibrate_experts(x, self.scale, self.bias, self._sizes, [self.manyshotIdx, self.mediumshotIdx, self.fewshotIdx],
+                                 self._empty_logprobs(x), not torch.is_grad_enabled())
 
 class DotProduct_Classifier(nn.Module):
 
-    def __init__(self, num_classes=1000, feat_dim=512, use_logits=False, *args):
+    def __init__(self, num_classes=1000, feat_dim=512, use_logits=True, *args):
         super(DotProduct_Classifier, self).__init__()
         self.num_classes = num_classes
         self.feat_dim = feat_dim
@@ -67,6 +96,55 @@ class DotProduct_Classifier(nn.Module):
             x = F.log_softmax(x, dim=1)                                  
         return x
 
+def export_int8(model, calib_loader, num_batches=10):
+    """Static int8 quantization of a (non BN-folded) feature extractor for CPU inference"""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    model = copy.deepcopy(model).float().cpu().eval()
+    example_inputs = (next(iter(calib_loader))[0],)
+
+    # fuses conv-bn(-relu) itself and observes activations, per-channel weights with fbgemm
+    prepared = prepare_fx(model, get_default_qconfig_mapping('fbgemm'), example_inputs)
+
+    with torch.no_grad():
+        for ind, batch in enumerate(calib_loader):
+            if ind == num_batches:
+                break
+            prepared(batch[0].float())
+
+    return convert_fx(prepared)
+
+class GraphedInference(nn.Module):
+    """Replays a CUDA graph of model's forward for inputs of example_input's shape, inference only"""
+
+    def __init__(self, model, example_input, warmup=3):
+        super(GraphedInference, self).__init__()
+        self.model = model
+        self.static_input = example_input.clone()
+
+        # warm up on a side stream before capturing, cudnn/allocator state must be settled
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.no_grad(), torch.cuda.stream(stream):
+            for _ in range(warmup):
+                self.model(self.static_input)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.no_grad(), torch.cuda.graph(self.graph):
+            self.static_output = self.model(self.static_input)
+
+    def forward(self, x, *args):
+        if x.shape != self.static_input.shape:      # e.g. the last, smaller batch
+            return self.model(x)
+        self.static_input.copy_(x)
+        self.graph.replay()
+        return self.static_output       # overwritten by the next call
+
+# dtypes the feature extractors can be run in at inference, inputs must be cast to match
+precisions = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
 ##############################################
 ######### based on Liu et. al's code #########
 ##############################################
@@ -159,25 +237,34 @@ class ResNet(nn.Module):
         self.layer2 = self._make_layer(block, 128, layers[1], stride=2)
         self.layer3 = self._make_layer(block, 256, layers[2], stride=2)
         self.layer4 = self._make_layer(block, 512, layers[3], stride=2)
-        self.avgpool = nn.AvgPool2d(7, stride=1)
+        self.avgpool = nn.AdaptiveAvgPool2d(1)
         
         self.use_fc = use_fc
-        self.use_dropout = True if dropout else False
 
-        if self.use_fc:
-            self.fc_add = nn.Linear(512*block.expansion, 512)
+        # identities when unused, keeping forward branch free
+        self.fc_add = nn.Linear(512*block.expansion, 512) if use_fc else nn.Identity()
+        self.fc_relu = nn.ReLU(inplace=True) if use_fc else nn.Identity()
 
-        if self.use_dropout:
+        if dropout:
             print('Using dropout.')
-            self.dropout = nn.Dropout(p=dropout)
+        self.dropout = nn.Dropout(p=dropout) if dropout else nn.Identity()
   
+        # he init (fan_out) of the convs, grouped by fan so each group is filled by a single normal_
+        conv_weights = {}
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
                 n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
-                m.weight.data.normal_(0, math.sqrt(2. / n))
+                conv_weights.setdefault(n, []).append(m.weight)
             elif isinstance(m, nn.BatchNorm2d):
-                m.weight.data.fill_(1)
-                m.bias.data.zero_()
+                nn.init.ones_(m.weight)
+                nn.init.zeros_(m.bias)
+
+        with torch.no_grad():
+            for n, weights in conv_weights.items():
+                numels = [w.numel() for w in weights]
+                samples = torch.empty(sum(numels)).normal_(0, math.sqrt(2. / n))
+                for w, sample in zip(weights, samples.split(numels)):
+                    w.copy_(sample.view_as(w))
 
     def _make_layer(self, block, planes, blocks, stride=1):
         downsample = None
@@ -196,7 +283,32 @@ class ResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
+    def fuse_for_inference(self):
+        """Fold every BatchNorm2d into its preceding conv (eval mode only)"""
+        if self.training:
+            raise Exception('BN folding uses running statistics, call model.eval() first.')
+
+        conv_bn_pairs = [(self, 'conv1', 'bn1')]
+        for m in self.modules():
+            if isinstance(m, BasicBlock):
+                conv_bn_pairs += [(m, 'conv1', 'bn1'), (m, 'conv2', 'bn2')]
+            elif isinstance(m, Bottleneck):
+                conv_bn_pairs += [(m, 'conv1', 'bn1'), (m, 'conv2', 'bn2'), (m, 'conv3', 'bn3')]
+            if isinstance(m, (BasicBlock, Bottleneck)) and m.downsample is not None:
+                conv_bn_pairs.append((m.downsample, '0', '1'))
+
+        for parent, conv_name, bn_name in conv_bn_pairs:
+            conv, bn = getattr(parent, conv_name), getattr(parent, bn_name)
+            if not isinstance(bn, nn.BatchNorm2d):      # already folded
+                continue
+            dtype = conv.weight.dtype       # fold in fp32, half precision running_var is too coarse
+            setattr(parent, conv_name, fuse_conv_bn_eval(conv.float(), bn.float()).to(dtype))
+            setattr(parent, bn_name, nn.Identity())
+
+        return self
+
     def forward(self, x, *args):
+        x = x.contiguous(memory_format=torch.channels_last)     # NHWC for the tensor core convs
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
@@ -206,27 +318,21 @@ class ResNet(nn.Module):
         x = self.layer2(x)
         x = self.layer3(x)
         x = self.layer4(x)
-    
-        feature_maps = None
 
         x = self.avgpool(x)
-        
-        x = x.view(x.size(0), -1)
-        
-        if self.use_fc:
-            x = F.relu(self.fc_add(x))
-
-        if self.use_dropout:
-            x = self.dropout(x)
+        x = torch.flatten(x, 1)
+        x = self.fc_relu(self.fc_add(x))
+        x = self.dropout(x)
 
-        return x, feature_maps
+        return x, None      # no feature maps
 
-def create_model_resnet10(use_fc=True, dropout=None, dataset=None, test=False, *args):
+def create_model_resnet10(use_fc=True, dropout=None, dataset=None, test=False, precision='fp32', *args):
     
     resnet10 = ResNet(BasicBlock, [1, 1, 1, 1], use_fc=use_fc, dropout=None)
+    resnet10 = resnet10.to(dtype=precisions[precision], memory_format=torch.channels_last)
     return resnet10
 
-def create_model_resnet152(use_fc=True, dropout=None, dataset=None, caffe=False, test=False):
+def create_model_resnet152(use_fc=True, dropout=None, dataset=None, caffe=False, test=False, precision='fp32'):
     
     resnet152 = ResNet(Bottleneck, [3, 8, 36, 3], use_fc=use_fc, dropout=None)    
     if caffe:
@@ -234,5 +340,6 @@ def create_model_resnet152(use_fc=True, dropout=None, dataset=None, caffe=False,
         resnet152 = init_weights(model=resnet152,
                                  weights_path='./data/caffe_resnet152.pth',
                                  caffe=True)
+    resnet152 = resnet152.to(dtype=precisions[precision], memory_format=torch.channels_last)
     return resnet152
 